@@ -21,8 +21,7 @@ if njoysticks < 1:
 
 print('Joysticks available:')
 for i in range(njoysticks):
-    joy = sdl2.SDL_JoystickOpen(i)
-    print(f'  - {sdl2.SDL_JoystickName(joy).decode()}')
+    print(f'  - {sdl2.SDL_JoystickNameForIndex(i).decode()}')
 
 joy = sdl2.SDL_JoystickOpen(0)
 
@@ -1,6 +1,14 @@
+import functools
+
 import sdl2, sdl2.sdlttf, sdl2.sdlmixer
 
-event_handlers = {}
+# handlers for each event type, indexed by the type itself.
+# Every entry starts as the same empty tuple, so the table is just references.
+event_handlers = [()] * (sdl2.SDL_LASTEVENT + 1)
+
+# events drained from the SDL queue with a single PeepEvents call
+_EVENT_BATCH_SIZE = 64
+_EVENT_BATCH = (sdl2.SDL_Event * _EVENT_BATCH_SIZE)()
 
 
 class EventLoop:
@@ -14,14 +22,22 @@ class EventLoop:
         self.keepRunning = False
 
     def pump(self, world):
-        # TODO: optimize eventloop to use more efficient functions like PeepEvents?
-        event = sdl2.SDL_Event()
-        while sdl2.SDL_PollEvent(event):
-            for event_handler in event_handlers.get(event.type, ()):
-                event_handler(event, world)
-                if not self.keepRunning:
-                    break
-            if not self.keepRunning:
+        # local aliases keep attribute and global lookups out of the per-event loop
+        peep = sdl2.SDL_PeepEvents
+        handlers = event_handlers
+        batch = _EVENT_BATCH
+
+        sdl2.SDL_PumpEvents()
+        while True:
+            n = peep(batch, _EVENT_BATCH_SIZE, sdl2.SDL_GETEVENT,
+                     sdl2.SDL_FIRSTEVENT, sdl2.SDL_LASTEVENT)
+            for i in range(n):
+                event = batch[i]
+                for event_handler in handlers[event.type]:
+                    event_handler(event, world)
+                    if not self.keepRunning:
+                        return
+            if n < _EVENT_BATCH_SIZE:
                 break
 
     def runloop(self, world, loopFunction):
@@ -37,11 +53,9 @@ class EventLoop:
 
 
 # so that we can use @decorators.
-# remember that, since append returns None, all of the functions won't really be defined
+# remember that, since handler returns None, all of the functions won't really be defined
 def handler(event_type, new_handler=None):
-    if event_type not in event_handlers:
-        event_handlers[event_type] = []
     if new_handler is None:
-        return event_handlers[event_type].append
+        return functools.partial(handler, event_type)
     else:
-        event_handlers[event_type].append(new_handler)
+        event_handlers[event_type] += (new_handler,)
@@ -4,14 +4,14 @@ SPDX-License-Identifier: MIT
 
 Author: Giovanni Grieco <giovanni@grieco.dev>
 """
-import collections
-import time
+import array
+import asyncio
+import functools
+import math
 import os
-from threading import Thread
-
-from scapy import sendrecv
-from scapy.layers.inet import IP, UDP
-from scapy.packet import Raw
+import socket
+import time
+from threading import Lock, Thread
 
 """
 Importing SDL2 in Windows could lead to an ImportError if DLL is not found.
@@ -21,7 +21,201 @@ if os.name == 'nt':
     os.environ['PYSDL2_DLL_PATH'] = os.curdir
 
 import sdl2
-import sdl2.ext
+
+
+# commands are queued already encoded, rc ones are formatted straight into bytes
+_RC_TEMPLATE = b'rc %d %d %d %d'
+# axis indexes, in the same order as the rc command arguments
+ROLL, PITCH, QUOTA, YAW = range(4)
+
+
+def _noop(*args):
+    """
+    Placeholder action for Joystick controls that are not mapped.
+    """
+
+
+class CommandQueue:
+    """
+    Fixed-size ring buffer to hand commands over from the joystick
+    thread (single producer) to the sender thread (single consumer).
+    Each index is written by one side only, so the GIL is enough to keep it consistent.
+    A short lock only guards the slot handover against in-place replacement.
+    """
+
+    def __init__(self, size=1024):
+        """
+        Parameters
+        ----------
+        size: queue capacity, must be a power of two.
+        """
+        if size & (size - 1):
+            raise ValueError(f'Queue size must be a power of two, got {size}')
+
+        self._buffer = [None] * size
+        self._mask = size - 1
+        self._head = 0     # next slot to read, written by the consumer only
+        self._tail = 0     # next slot to write, written by the producer only
+        self._flushed = 0  # commands before this index are discarded, written by the producer only
+        self._replace_lock = Lock()
+        self._waiter = None  # wakes up a consumer awaiting pop_async
+
+    def __len__(self):
+        return self._tail - max(self._head, self._flushed)
+
+    def append(self, cmd):
+        """
+        Enqueue a command. Commands exceeding the queue capacity are dropped.
+
+        Returns
+        -------
+        True if the command has been enqueued, False otherwise.
+        """
+        tail = self._tail
+        if tail - self._head > self._mask:
+            # the free slot may only come from clear(), make sure the consumer isn't reading it
+            with self._replace_lock:
+                if tail - max(self._head, self._flushed) > self._mask:
+                    return False
+                self._buffer[tail & self._mask] = cmd
+        else:
+            self._buffer[tail & self._mask] = cmd
+
+        self._tail = tail + 1
+
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            try:
+                waiter()
+            except RuntimeError:  # the consumer loop has been closed meanwhile
+                pass
+        return True
+
+    def pop(self):
+        """
+        Dequeue the oldest command, without waiting.
+
+        Raises
+        ------
+        IndexError: if the queue is empty.
+        """
+        return self._take()
+
+    async def pop_async(self, timeout=None):
+        """
+        Dequeue the oldest command, waiting up to timeout seconds on the running event loop
+        for one to be available.
+
+        Raises
+        ------
+        IndexError: if the queue is still empty after the timeout.
+        """
+        head = max(self._head, self._flushed)
+        if head == self._tail:
+            loop = asyncio.get_running_loop()
+            ready = loop.create_future()
+            self._waiter = functools.partial(loop.call_soon_threadsafe, _resolve, ready, None)
+            try:
+                # an append may have landed before the waiter was installed
+                if head == self._tail:
+                    await asyncio.wait_for(ready, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                # the loop may be closing (e.g. cancelled on shutdown), never leave it behind
+                self._waiter = None
+            head = max(self._head, self._flushed)
+            if head == self._tail:
+                raise IndexError('pop from an empty queue')
+
+        return self._take()
+
+    def _take(self):
+        """
+        Consume the oldest command. The head is read again under the lock,
+        as a concurrent clear() may have moved it.
+
+        Raises
+        ------
+        IndexError: if the queue has been cleared in the meantime.
+        """
+        with self._replace_lock:
+            head = max(self._head, self._flushed)
+            if head == self._tail:
+                raise IndexError('pop from an empty queue')
+            slot = head & self._mask
+            cmd = self._buffer[slot]
+            self._buffer[slot] = None
+            self._head = head + 1
+        return cmd
+
+    def replace_last(self, cmd, prefix):
+        """
+        Overwrite the most recent command if it is still pending and starts with prefix,
+        enqueue it otherwise.
+
+        Returns
+        -------
+        True if the command has been replaced or enqueued, False otherwise.
+        """
+        with self._replace_lock:
+            tail = self._tail
+            if tail > max(self._head, self._flushed):
+                slot = (tail - 1) & self._mask
+                if self._buffer[slot].startswith(prefix):
+                    self._buffer[slot] = cmd
+                    return True
+
+        return self.append(cmd)
+
+    def clear(self):
+        """
+        Discard every pending command in O(1). The consumer skips them on the next pop.
+        """
+        self._flushed = self._tail
+
+
+def _resolve(future, result):
+    """
+    Set the result of a future, unless it is already done.
+    """
+    if not future.done():
+        future.set_result(result)
+
+
+class DroneProtocol(asyncio.DatagramProtocol):
+    """
+    Deliver drone responses to the command that is waiting for them.
+    """
+
+    def __init__(self):
+        self._response = None
+
+    def expect_response(self):
+        """
+        Returns
+        -------
+        A future resolved with the next response, or with None if interrupted.
+        """
+        self._response = asyncio.get_running_loop().create_future()
+        return self._response
+
+    def interrupt(self):
+        """
+        Stop waiting for the current response, if any.
+        """
+        if self._response is not None:
+            _resolve(self._response, None)
+
+    def error_received(self, exc):
+        # e.g. the drone is not reachable, the command is lost as any other datagram
+        print(f'Command not delivered: {exc}')
+
+    def datagram_received(self, data, addr):
+        # responses nobody is waiting for (e.g. late ones) are dropped
+        if self._response is not None:
+            _resolve(self._response, data.decode())
 
 
 class JoystickController:
@@ -35,7 +229,10 @@ class JoystickController:
         Initialize useful constants and routing mapping to setup controller actions.
         """
         self._running = True
-        self._command_queue = collections.deque()
+        self._command_queue = CommandQueue()
+        self._sock = self._init_socket()
+        self._send_loop = None  # event loop of the sender thread, once running
+        self._protocol = None
 
         ###
         # You may want to customize the constants and button mapping below
@@ -43,49 +240,47 @@ class JoystickController:
         ###
         self._joystick = self._init_joystick()
         self._AXIS_DEAD = 2500
-        self._AXIS_MAX_VAL = 32767
-        self._axis_state = {
-            'roll':  0,
-            'quota': 0,
-            'yaw':   0,
-            'pitch': 0
-        }
+        self._AXIS_DEAD_SQ = self._AXIS_DEAD * self._AXIS_DEAD  # compare squares, saves abs()
+        self._AXIS_SHIFT = 15  # axis values span a signed 16-bit range, scale by 2^15
+        self._AXIS_ROUND = 1 << (self._AXIS_SHIFT - 1)  # round to nearest, so 32767 still gives 100
+        self._RC_PERIOD = 0.05  # analog sticks are sampled at 20 Hz
+        self._axis_state = array.array('i', (0, 0, 0, 0))
         self._event_map = {
             'SELECT':  self._land,
             'START':   self._takeoff,
             'A':       self._emergency_land,
-            'Y':       self._command,
-            'LEFT_X':  self._set_roll,
-            'LEFT_Y':  self._set_pitch,
-            'RIGHT_X': self._set_yaw,
-            'RIGHT_Y': self._set_quota
+            'Y':       self._command
+        }
+        # rc axis index and direction of each analog stick axis
+        self._rc_map = {
+            'LEFT_X':  (ROLL, 1),
+            'LEFT_Y':  (PITCH, -1),
+            'RIGHT_X': (YAW, 1),
+            'RIGHT_Y': (QUOTA, -1)
         }
         self._button_map = ('A', 'B', 'X', 'Y', 'LB', 'RB', 'SELECT', 'START', 'JL', 'JR')
         self._axis_map = ('LEFT_X', 'LEFT_Y', 'LT', 'RIGHT_X', 'RIGHT_Y', 'RT')
 
+        # jump table indexed by button ID, unmapped buttons do nothing
+        self._button_dispatch = tuple(self._event_map.get(name, _noop) for name in self._button_map)
+        # (Joystick axis ID, rc axis index, direction) of each sampled axis
+        self._rc_axes = tuple((self._axis_map.index(name), index, sign)
+                              for name, (index, sign) in self._rc_map.items())
+
         print(f'Connected to {sdl2.SDL_JoystickName(self._joystick).decode()}')
 
     def run(self):
         """
         Main runtime procedure.
-        Manage threads, an empty loop and shutdown procedure in case of program termination.
+        Joystick events are handled by a dedicated thread, while commands are sent
+        from the main thread until program termination.
         """
-        threads = (
-            Thread(target=self._receive_command_loop, daemon=True),
-            Thread(target=self._send_command_loop, daemon=False),
-        )
+        receiver = Thread(target=self._receive_command_loop, daemon=True)
+        receiver.start()
 
-        for t in threads:
-            t.start()
+        self._send_command_loop()
 
-        self._run_loop()
-
-        # if we exit from the run loop for some reason, shutdown
-        self._command_queue.clear()
-        self._land()
-
-        for t in threads:
-            t.join()
+        receiver.join()
 
     @staticmethod
     def _init_joystick():
@@ -97,72 +292,153 @@ class JoystickController:
         -------
         The SDL Joystick object.
         """
+        # stop each poll round at a sentinel, so that a flood of axis events can't stall it
+        sdl2.SDL_SetHint(b'SDL_POLL_SENTINEL', b'1')
         sdl2.SDL_Init(sdl2.SDL_INIT_JOYSTICK)
 
+        # only joystick events are handled, don't let anything else into the queue.
+        # Axis motion is sampled instead: SDL keeps axis state up to date without its events.
+        wanted_events = {
+            sdl2.SDL_QUIT,
+            sdl2.SDL_JOYBUTTONDOWN,
+            sdl2.SDL_JOYBUTTONUP,
+            sdl2.SDL_JOYDEVICEADDED,
+            sdl2.SDL_JOYDEVICEREMOVED,
+            getattr(sdl2, 'SDL_POLLSENTINEL', 0x7F00),
+        }
+        # event types are the SDL_* constants from 0x100 on, smaller ones are flags and sizes
+        event_types = {value for name, value in vars(sdl2.events).items()
+                       if name.startswith('SDL_') and isinstance(value, int)
+                       and sdl2.SDL_FIRSTEVENT < value < sdl2.SDL_LASTEVENT and value >= 0x100}
+        for event_type in event_types - wanted_events:
+            sdl2.SDL_EventState(event_type, sdl2.SDL_IGNORE)
+
         njoysticks = sdl2.SDL_NumJoysticks()
         if njoysticks < 1:
             raise RuntimeError(f'No joysticks connected!')
 
         print('Joysticks available:')
         for i in range(njoysticks):
-            joy = sdl2.SDL_JoystickOpen(i)
-            print(f'  - {sdl2.SDL_JoystickName(joy).decode()}')
+            print(f'  - {sdl2.SDL_JoystickNameForIndex(i).decode()}')
 
         return sdl2.SDL_JoystickOpen(0)
 
-    def _run_loop(self):
+    @staticmethod
+    def _init_socket():
         """
-        Main running loop, just to check and handle interrupt signal.
+        Open the UDP socket used to send commands to the drone. It is connected once,
+        so that only the drone replies are received.
+
+        Returns
+        -------
+        The connected UDP socket.
         """
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            self._running = False
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(('192.168.10.1', 8889))
+        return sock
 
     def _receive_command_loop(self):
         """
-        Manage Joystick events and call their mapped function.
+        Manage Joystick events and call their mapped function, and sample analog sticks
+        every _RC_PERIOD seconds. The thread sleeps until an event arrives or a sample is due.
         """
+        # local aliases keep attribute and global lookups out of the per-event loop
+        wait = sdl2.SDL_WaitEventTimeout
+        peep = sdl2.SDL_PeepEvents
+        handle = self._handle_event
+        get_event, first_event, last_event = sdl2.SDL_GETEVENT, sdl2.SDL_FIRSTEVENT, sdl2.SDL_LASTEVENT
+
+        event = sdl2.SDL_Event()
+        next_sample = time.monotonic()
         while self._running:
-            for event in sdl2.ext.get_events():
-                try:
-                    if event.type == sdl2.SDL_JOYBUTTONDOWN:
-                        self._event_map[self._button_map[event.jbutton.button]]()
-                    elif event.type == sdl2.SDL_JOYAXISMOTION:
-                        if abs(event.jaxis.value) > self._AXIS_DEAD:
-                            self._event_map[self._axis_map[event.jaxis.axis]](event.jaxis.value)
-                except KeyError:
-                    pass
+            # round up, or the last fraction of a millisecond would spin on a zero timeout
+            timeout_ms = max(math.ceil((next_sample - time.monotonic()) * 1000), 0)
+            if wait(event, timeout_ms):
+                handle(event)
+                # drain whatever else is already queued without waiting again
+                while peep(event, 1, get_event, first_event, last_event) > 0:
+                    handle(event)
+
+            now = time.monotonic()
+            if now >= next_sample:
+                self._sample_axes()
+                next_sample = now + self._RC_PERIOD
+
+    def _handle_event(self, event):
+        """
+        Call the function mapped to a Joystick event.
+        """
+        try:
+            if event.type == sdl2.SDL_JOYBUTTONDOWN:
+                self._button_dispatch[event.jbutton.button]()
+        except IndexError:  # button not listed in the button map
+            pass
 
     def _send_command_loop(self):
+        """
+        Run the command sender on an asyncio event loop, until the interrupt signal.
+        """
+        try:
+            asyncio.run(self._send_worker())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._running = False
+
+    async def _send_worker(self):
         """
         Handle command execution using hard real-time, FCFS-based scheduling policy.
         """
-        while self._running:
-            try:
-                cmd = self._command_queue.pop()
+        loop = asyncio.get_running_loop()
+        transport, self._protocol = await loop.create_datagram_endpoint(DroneProtocol, sock=self._sock)
+        self._send_loop = loop
 
-                answer = sendrecv.sr1(IP(dst='192.168.10.1') / UDP(dport=8889) / cmd,
-                                      verbose=1,
-                                      timeout=0.2)
+        try:
+            while self._running:
                 try:
-                    response = answer[Raw].load.decode()
-                    print(f'EXE {cmd}: {response}')
-                except TypeError:
-                    print(f'EXE {cmd}: unknown')
+                    cmd = await self._command_queue.pop_async(timeout=0.5)
+                except IndexError:  # nothing to schedule, retry another time
                     continue
 
-            except IndexError:  # nothing to schedule, retry another time
-                time.sleep(0.5)
-                continue
+                if cmd.startswith(b'rc '):
+                    # rc commands are not acknowledged, don't wait for a response
+                    transport.sendto(cmd)
+                else:
+                    await self._execute(transport, cmd)
+        finally:
+            # if we exit from the send loop for some reason, land before shutdown
+            self._send_loop = None
+            print('Landing before shutdown')
+            transport.sendto(b'land')
+            transport.close()
+
+    async def _execute(self, transport, cmd):
+        """
+        Send a command to the drone and wait for its response.
+        The wait is cut short by an emergency landing.
+        """
+        response = self._protocol.expect_response()
+        transport.sendto(cmd)
+        try:
+            response = await asyncio.wait_for(response, 0.2)
+        except asyncio.TimeoutError:
+            response = None
+
+        print(f'EXE {cmd.decode()}: {response or "unknown"}')
+
+    def _schedule(self, cmd):
+        """
+        Enqueue a command, reporting it if the queue is full.
+        """
+        if not self._command_queue.append(cmd):
+            print(f'Command queue is full, dropped {cmd.decode()}')
 
     def _command(self):
         """
         Take control of the DJI Tello.
         """
         print('Pressed Command button')
-        self._command_queue.append('command')
+        self._schedule(b'command')
 
     def _land(self, force=False):
         """
@@ -176,7 +452,7 @@ class JoystickController:
         if force:
             self._command_queue.clear()
 
-        self._command_queue.append('land')
+        self._schedule(b'land')
 
     def _emergency_land(self):
         """
@@ -184,7 +460,15 @@ class JoystickController:
         Caution: don't harm the drone!
         """
         self._command_queue.clear()
-        self._command_queue.append('emergency')
+        self._command_queue.append(b'emergency')
+
+        # don't let the sender wait for the response of a command issued before
+        loop = self._send_loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._protocol.interrupt)
+            except RuntimeError:  # the sender loop has been closed meanwhile
+                pass
 
     def _takeoff(self):
         """
@@ -192,46 +476,30 @@ class JoystickController:
         Note: if drone is not taking off, check your battery charge level!
         """
         print('Pressed Takeoff button')
-        self._command_queue.append('takeoff')
-
-    def _set_roll(self, raw_val):
-        """
-        Set roll axis value.
-        """
-        val = int(raw_val * 100 / self._AXIS_MAX_VAL)
-
-        if self._axis_state['roll'] != val:
-            self._axis_state['roll'] = val
-            self._dispatch_axis_update()
+        self._schedule(b'takeoff')
 
-    def _set_quota(self, raw_val):
+    def _sample_axes(self):
         """
-        Set quota axis value.
-        """
-        val = -int(raw_val * 100 / self._AXIS_MAX_VAL)
-
-        if self._axis_state['quota'] != val:
-            self._axis_state['quota'] = val
-            self._dispatch_axis_update()
-
-    def _set_yaw(self, raw_val):
+        Read the analog sticks, scaled from the Joystick range to [-100, 100],
+        and schedule an update if any axis value changed.
         """
-        Set yaw axis value.
-        """
-        val = int(raw_val * 100 / self._AXIS_MAX_VAL)
-
-        if self._axis_state['yaw'] != val:
-            self._axis_state['yaw'] = val
-            self._dispatch_axis_update()
-
-    def _set_pitch(self, raw_val):
-        """
-        Set pitch axis value.
-        """
-        val = -int(raw_val * 100 / self._AXIS_MAX_VAL)
-
-        if self._axis_state['pitch'] != val:
-            self._axis_state['pitch'] = val
+        get_axis = sdl2.SDL_JoystickGetAxis
+        joystick = self._joystick
+        axis = self._axis_state
+        dead_sq = self._AXIS_DEAD_SQ
+        changed = False
+
+        for axis_id, index, sign in self._rc_axes:
+            raw_val = get_axis(joystick, axis_id)
+            if raw_val * raw_val <= dead_sq:
+                raw_val = 0
+            val = sign * ((raw_val * 100 + self._AXIS_ROUND) >> self._AXIS_SHIFT)
+
+            if axis[index] != val:
+                axis[index] = val
+                changed = True
+
+        if changed:
             self._dispatch_axis_update()
 
     def _dispatch_axis_update(self):
@@ -240,10 +508,8 @@ class JoystickController:
         managed using Joystick analog sticks.
         """
         # print(f'RC: {self._axis_state}')  # Caution: this message is highly frequent
-        self._command_queue.append(f'rc {self._axis_state["roll"]} '
-                                   f'{self._axis_state["pitch"]} '
-                                   f'{self._axis_state["quota"]} '
-                                   f'{self._axis_state["yaw"]}')
+        # a pending rc command is stale by now, just overwrite it
+        self._command_queue.replace_last(_RC_TEMPLATE % tuple(self._axis_state), b'rc ')
 
 
 if __name__ == '__main__':